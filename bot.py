@@ -7,11 +7,15 @@ import re
 import json
 import tempfile
 import subprocess
+import glob
+import hashlib
 import threading
 import sys
 import gc
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import CommandStart, Command
 from aiogram.types import (
@@ -25,60 +29,93 @@ from aiogram.exceptions import TelegramEntityTooLarge, TelegramNetworkError
 import aiohttp
 import io
 
-from config import BOT_TOKEN, PROXY_URL, ENABLE_CLEANUP, USE_PROXY, ENABLE_API
+from config import BOT_TOKEN, PROXY_URL, ENABLE_CLEANUP, USE_PROXY, ENABLE_API, USE_PROCESS_POOL_STT
 from database import Database
 
+# Полный gc.collect обходит все три поколения и блокирует поток —
+# выполняем не чаще раза в минуту, сколько бы раз его ни попросили
+_last_gc = 0.0
+
+def _maybe_gc():
+    """Троттлинг полного сборщика мусора (не чаще раза в 60 секунд)"""
+    global _last_gc
+    now = time.monotonic()
+    if now - _last_gc > 60:
+        _last_gc = now
+        gc.collect()
+
+# Корневые пакеты тяжёлых модулей; подмодули (yt_dlp.extractor, PIL.Image и т.д.)
+# покрываются проверкой префикса
+_UNLOAD_EXACT = frozenset([
+    'speech_recognition', 'pydub', 'cv2', 'numpy', 'PIL', 'qrcode',
+    'yt_dlp', 'pytubefix'
+])
+_UNLOAD_PREFIXES = tuple(name + '.' for name in _UNLOAD_EXACT)
+
 def unload_heavy_modules():
     """Выгружает тяжёлые модули из памяти после использования.
     БЕЗОПАСНАЯ версия: только удаляет из sys.modules, без очистки __dict__,
     чтобы не ломать параллельные потоки, которые уже держат ссылки на модуль."""
-    modules_to_unload = [
-        'speech_recognition', 'pydub', 'cv2', 'numpy', 'PIL', 'qrcode',
-        'yt_dlp', 'pytubefix', 'yt_dlp.extractor', 'yt_dlp.downloader',
-        'yt_dlp.postprocessor', 'yt_dlp.utils', 'pydub.utils',
-        'PIL.Image', 'PIL._imaging', 'cv2.cv2'
-    ]
-    for module_name in modules_to_unload:
-        keys_to_remove = [key for key in list(sys.modules.keys()) if key == module_name or key.startswith(module_name + '.')]
-        for key in keys_to_remove:
-            try:
-                del sys.modules[key]
-            except KeyError:
-                pass
+    # Один проход по sys.modules вместо полного сканирования на каждый префикс
+    victims = [key for key in list(sys.modules)
+               if key in _UNLOAD_EXACT or key.startswith(_UNLOAD_PREFIXES)]
+    for key in victims:
+        sys.modules.pop(key, None)
+
+    if victims:
+        _maybe_gc()
 
-    gc.collect()
+# Долгоживущий psutil.Process: один объект на весь процесс, а
+# cpu_percent(interval=None) считает загрузку с прошлого вызова без
+# блокирующего сна в 100мс, который был у interval=0.1
+_resource_proc = None
+_last_fds_check = 0.0
+_last_fds = 0
+
+def _get_resource_proc():
+    """Ленивая инициализация psutil.Process с затравкой счётчика CPU"""
+    global _resource_proc
+    if _resource_proc is None:
+        import psutil
+        _resource_proc = psutil.Process(os.getpid())
+        _resource_proc.cpu_percent(interval=None)  # первый вызов всегда 0.0
+    return _resource_proc
 
 def log_resource_usage(context: str):
     """Подробное логирование использования RAM и CPU"""
+    global _last_fds_check, _last_fds
     try:
         import psutil
-        import os
-        
-        process = psutil.Process(os.getpid())
-        
+
+        process = _get_resource_proc()
+
         # RAM информация
         memory_info = process.memory_info()
         rss_mb = memory_info.rss / (1024 * 1024)  # Resident Set Size в MB
         vms_mb = memory_info.vms / (1024 * 1024)  # Virtual Memory Size в MB
-        
-        # CPU информация
-        cpu_percent = process.cpu_percent(interval=0.1)
+
+        # CPU информация (неблокирующий замер с прошлого вызова)
+        cpu_percent = process.cpu_percent(interval=None)
         cpu_times = process.cpu_times()
-        
+
         # Системная память
         system_memory = psutil.virtual_memory()
         system_memory_percent = system_memory.percent
         system_memory_available_mb = system_memory.available / (1024 * 1024)
-        
+
         # Количество потоков
         num_threads = process.num_threads()
-        
-        # Количество открытых файловых дескрипторов
-        try:
-            num_fds = process.num_fds() if hasattr(process, 'num_fds') else len(process.open_files())
-        except:
-            num_fds = 0
-        
+
+        # Дескрипторы считаем не чаще раза в минуту: это скан /proc/<pid>/fd
+        now = time.monotonic()
+        if now - _last_fds_check > 60:
+            try:
+                _last_fds = process.num_fds() if hasattr(process, 'num_fds') else len(process.open_files())
+            except:
+                _last_fds = 0
+            _last_fds_check = now
+        num_fds = _last_fds
+
         logger.info(
             f"[RESOURCES] {context} | "
             f"RAM: {rss_mb:.2f} MB (RSS) / {vms_mb:.2f} MB (VMS) | "
@@ -96,7 +133,12 @@ def log_resource_usage(context: str):
         logger.warning(f"[RESOURCES] Error logging resources for {context}: {e}")
         sys.stdout.flush()
 
-# Ленивая загрузка тяжёлых модулей - импортируем только когда нужно
+# Ленивая загрузка тяжёлых модулей - импортируем только когда нужно.
+# Сознательно НЕ через module-level lazy-прокси (lazy_import / PEP 562
+# __getattr__): глобальная ссылка на модуль пережила бы unload_heavy_modules
+# и выгрузка по простою перестала бы освобождать память. Повторный
+# `import x` уже загруженного модуля — это один просмотр sys.modules,
+# import-lock на этом пути не берётся.
 # НЕ импортируем на уровне модуля:
 # - yt_dlp (тяжёлый, только при скачивании)
 # - speech_recognition (тяжёлый, только при транскрибации)
@@ -117,6 +159,10 @@ API_TOKEN = os.environ.get("API_TOKEN", "YOUR_API_TOKEN_HERE")
 # Prompt for summary generation (сжатый, оптимизированный)
 PROMPT = """Ты эксперт по созданию кратких саммари. Создай пронумерованный список ключевых пунктов из расшифровки голосового сообщения. ВАЖНО: Это расшифровка голосового сообщения, возможны ошибки распознавания речи. Поняй смысл по контексту и молча исправь/переформулируй текст естественно, чтобы он был понятным и логичным. Правила: 1) Начни сразу со списка без вводных фраз 2) Каждый пункт - одна ключевая мысль или факт 3) Определи пол говорящего по контексту и СТРОГО соблюдай его во всех пунктах, сохраняя первое лицо (я, у меня, мой/моя/моё) 4) Включи 5-10 самых важных пунктов 5) Используй только цифры с точкой (1. 2. 3.) 6) Пиши кратко и по существу 7) Сохраняй хронологию событий если она важна 8) Исправляй очевидные ошибки распознавания речи, сохраняя смысл 9) Переформулируй неясные фразы для лучшего понимания 10) Исправляй искаженные слова по смыслу 11) Сохраняй естественность речи и логику повествования 12) Если речь неразборчива или слишком короткая, укажи это в саммари. Расшифровка: {input_text}"""
 
+# Версия промпта входит в ключ кэша саммари: при правке текста выше
+# старые закэшированные саммари автоматически перестают подходить
+_PROMPT_TAG = hashlib.blake2b(PROMPT.encode(), digest_size=4).hexdigest()
+
 # Ленивая инициализация Speech Recognition (создаём только при первом использовании)
 _recognizer = None
 
@@ -138,9 +184,10 @@ def get_recognizer():
 # Batch processing system for multiple voice messages
 BATCH_TIMEOUT = 0.5  # Delay to catch rapid messages (0.5 seconds)
 BATCH_MAX_SIZE = 50  # Maximum messages in a batch
-user_message_batches = {}  # user_id -> list of messages
-batch_timers = {}  # user_id -> timer
-batch_lock = threading.Lock()
+# Очередь и воркер на пользователя: батчи собираются внутри event loop'а,
+# без threading.Timer и общего мьютекса на все чаты
+_user_queues = {}  # user_id -> asyncio.Queue входящих сообщений
+_user_workers = {}  # user_id -> задача-воркер, собирающая батчи
 user_last_message_time = {}  # user_id -> timestamp of last message
 
 # Transcription functions
@@ -163,12 +210,15 @@ def transcribe_single_segment(audio_path):
         
         recognizer = get_recognizer()
         with sr.AudioFile(audio_path) as source:
-            # Настройка для фонового шума (duration должен быть >= non_speaking_duration)
-            try:
-                recognizer.adjust_for_ambient_noise(source, duration=0.5)
-            except (AssertionError, AttributeError) as e:
-                # Если возникает ошибка, пропускаем adjust (динамическая настройка включена)
-                logger.debug(f"Skipping ambient noise adjustment: {e}")
+            # Настройка для фонового шума (duration должен быть >= non_speaking_duration).
+            # Сегменты из _split_wav_segments уже нормализованы к 16кГц моно —
+            # для них пропускаем лишний RMS-проход по файлу
+            if '_segment_' not in os.path.basename(audio_path):
+                try:
+                    recognizer.adjust_for_ambient_noise(source, duration=0.5)
+                except (AssertionError, AttributeError) as e:
+                    # Если возникает ошибка, пропускаем adjust (динамическая настройка включена)
+                    logger.debug(f"Skipping ambient noise adjustment: {e}")
             
             audio_data = recognizer.record(source)
             try:
@@ -202,44 +252,214 @@ def transcribe_single_segment(audio_path):
         logger.error(f"Error in transcribe_single_segment for {audio_path}: {e}", exc_info=True)
         return ""
 
-def transcribe_audio_segments(audio_path, max_segment_duration=30):
-    """Transcribe audio by splitting it into segments for better accuracy"""
+async def _extract_wav(src, dst):
+    """Извлекает аудиодорожку в 16кГц моно WAV нативным asyncio-процессом.
+
+    В отличие от subprocess.run в to_thread, не занимает поток пула на всё
+    время извлечения и не копит stdout ffmpeg в памяти.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-loglevel', 'error', '-i', src, '-vn', '-acodec', 'pcm_s16le',
+        '-ar', '16000', '-ac', '1', '-y', dst,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    _, err = await proc.communicate()
+    if proc.returncode:
+        raise RuntimeError(err.decode(errors='replace'))
+
+def _audio_content_hash(audio_path):
+    """SHA-256 содержимого файла; file_digest читает и хэширует на стороне C"""
+    with open(audio_path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+def _quick_media_hash(media_path):
+    """Быстрый отпечаток исходного медиафайла: blake2b первого мегабайта + размер.
+
+    Полный SHA-256 гигабайтного видео читает весь файл, а здесь хэш нужен ещё
+    до извлечения аудио — чтобы при повторном запросе не запускать ffmpeg вовсе.
+    Первый мегабайт контейнера вместе с размером надёжно различает файлы.
+    """
+    size = os.path.getsize(media_path)
+    h = hashlib.blake2b(digest_size=16)
+    with open(media_path, 'rb') as f:
+        h.update(f.read(1024 * 1024))
+    h.update(str(size).encode())
+    return h.hexdigest()
+
+async def get_cached_transcription(audio_path):
+    """Ищет готовую расшифровку по хэшу содержимого аудио.
+
+    Возвращает (ключ для save_transcription, текст или None): одинаковое
+    аудио (то же видео, пересланный файл) расшифровываем только один раз —
+    попадание превращает многосекундный поход в Google в один SELECT.
+    """
+    audio_hash = await asyncio.to_thread(_audio_content_hash, audio_path)
+    hash_key = f"hash:{audio_hash}"
+    return hash_key, db.get_transcription(hash_key)
+
+async def _pipeline_transcribe(local_input_path, task_dir, status_msg, user_id,
+                               media_hash=None, use_semaphore=False):
+    """Общий конвейер «извлечь аудио → расшифровать» для веток transcription и summary.
+
+    Сначала пробует кэш по быстрому отпечатку исходного файла (попадание
+    избавляет и от ffmpeg, и от распознавания), затем извлекает WAV и
+    проверяет кэш по хэшу аудио. Возвращает текст расшифровки или None;
+    статусные сообщения об ошибках редактирует сам, очистка task_dir
+    остаётся на вызывающем.
+    """
+    if media_hash is None:
+        media_hash = await asyncio.to_thread(_quick_media_hash, local_input_path)
+    media_key = f"media:{media_hash}"
+    transcribed_text = db.get_transcription(media_key)
+    if transcribed_text:
+        return transcribed_text
+
+    await status_msg.edit_text("⏳ Извлекаю аудио...")
+    temp_audio_path = os.path.join(task_dir, "audio.wav")
+
+    # Извлекаем аудио из видео (с ограничением параллельных операций)
+    async with conversion_semaphore:
+        await _extract_wav(local_input_path, temp_audio_path)
+
+    if not os.path.exists(temp_audio_path) or os.path.getsize(temp_audio_path) == 0:
+        await status_msg.edit_text("❌ Не удалось извлечь аудио")
+        return None
+
+    await status_msg.edit_text("⏳ Расшифровываю аудио...")
+    hash_key, transcribed_text = await get_cached_transcription(temp_audio_path)
+    if not transcribed_text:
+        if use_semaphore:
+            async with transcription_semaphore:
+                transcribed_text = await transcribe_audio_segments(temp_audio_path)
+        else:
+            transcribed_text = await transcribe_audio_segments(temp_audio_path)
+        if transcribed_text and transcribed_text.strip():
+            db.save_transcription(hash_key, user_id, transcribed_text)
+
+    if transcribed_text and transcribed_text.strip():
+        # Дублируем под быстрым ключом, чтобы в следующий раз
+        # не запускать даже извлечение аудио
+        db.save_transcription(media_key, user_id, transcribed_text)
+        return transcribed_text
+
+    await status_msg.edit_text("❌ Не удалось распознать речь")
+    return None
+
+# Отдельный пул процессов для CPU-bound локального STT (включается флагом
+# USE_PROCESS_POOL_STT): потоки в этом случае упираются в GIL. Для дефолтного
+# Google HTTP backend'а остаётся обычный to_thread
+_stt_pool = None
+
+def get_stt_pool():
+    """Ленивая инициализация пула процессов для транскрибации"""
+    global _stt_pool
+    if _stt_pool is None:
+        # ~20МБ RSS на воркер — на маленьких VPS не раздуваем пул
+        _stt_pool = ProcessPoolExecutor(max_workers=max(2, min(4, (os.cpu_count() or 2) // 2)))
+    return _stt_pool
+
+def _wav_duration(audio_path):
+    """Длительность аудио в секундах через ffprobe (без декодирования файла)"""
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+         '-of', 'default=noprint_wrappers=1:nokey=1', audio_path],
+        check=True, capture_output=True, text=True
+    )
+    return float(result.stdout.strip())
+
+def _split_wav_segments(audio_path, max_segment_duration):
+    """Нарезает WAV на сегменты; возвращает None, если файл короче одного сегмента"""
+    if _wav_duration(audio_path) <= max_segment_duration:
+        return None
+
+    # Сегментный мьюксер ffmpeg режет поток, не держа весь PCM в памяти,
+    # как это делал pydub; заодно приводим сегменты к 16кГц моно s16le —
+    # recognize_google загружает PCM как есть, и 48кГц стерео это ~4x байт
+    # без выигрыша в качестве распознавания
+    output_pattern = audio_path.replace('.wav', '_segment_%03d.wav')
+    subprocess.run(
+        ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-i', audio_path,
+         '-f', 'segment', '-segment_time', str(max_segment_duration),
+         '-ar', '16000', '-ac', '1', '-c:a', 'pcm_s16le', output_pattern],
+        check=True, capture_output=True
+    )
+
+    return sorted(glob.glob(audio_path.replace('.wav', '_segment_*.wav')))
+
+async def transcribe_audio_segments(audio_path, max_segment_duration=30):
+    """Transcribe audio by splitting it into segments for better accuracy
+
+    Сознательно не используем google.cloud.speech long_running_recognize:
+    один запрос на весь файл избавил бы от посегментных round-trip'ов, но
+    требует сервисный аккаунт GCP и GCS-бакет для файлов длиннее минуты,
+    которых у проекта нет — распознавание работает через бесключевой
+    endpoint recognize_google. Параллельный gather по сегментам уже убирает
+    последовательную задержку, ради которой затевался long_running путь.
+
+    По той же причине здесь нет микробатчинга запросов (очередь + один
+    батчевый forward pass): он окупается только с локальной Whisper-подобной
+    моделью, у HTTP-распознавания батчевого API просто нет, а межзапросный
+    параллелизм уже даёт transcription_semaphore.
+    """
     try:
-        # Ленивая загрузка pydub только когда нужно
-        from pydub import AudioSegment
-        audio = AudioSegment.from_wav(audio_path)
-        total_duration = len(audio) / 1000.0
-        
-        if total_duration <= max_segment_duration:
-            return transcribe_single_segment(audio_path)
-        
-        segments = []
-        segment_length = max_segment_duration * 1000
-        
-        for i in range(0, len(audio), segment_length):
-            segment = audio[i:i + segment_length]
-            segment_path = audio_path.replace('.wav', f'_segment_{i//segment_length}.wav')
-            segment.export(segment_path, format="wav")
-            segments.append(segment_path)
-        
-        transcribed_texts = []
-        for segment_path in segments:
+        segments = await asyncio.to_thread(_split_wav_segments, audio_path, max_segment_duration)
+
+        if segments is None:
+            return await asyncio.to_thread(transcribe_single_segment, audio_path)
+
+        async def transcribe_one(segment_path):
             try:
-                segment_text = transcribe_single_segment(segment_path)
-                if segment_text and segment_text.strip():
-                    transcribed_texts.append(segment_text.strip())
-            except Exception as e:
-                logger.warning(f"Failed to transcribe segment {segment_path}: {e}")
-                continue
+                # Не больше 8 сегментов к Google одновременно
+                async with segment_semaphore:
+                    if USE_PROCESS_POOL_STT:
+                        loop = asyncio.get_running_loop()
+                        return await loop.run_in_executor(
+                            get_stt_pool(), transcribe_single_segment, segment_path)
+                    return await asyncio.to_thread(transcribe_single_segment, segment_path)
             finally:
                 if os.path.exists(segment_path):
                     os.remove(segment_path)
-        
+
+        results = await asyncio.gather(*(transcribe_one(p) for p in segments), return_exceptions=True)
+
+        transcribed_texts = []
+        for segment_path, result in zip(segments, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Failed to transcribe segment {segment_path}: {result}")
+                continue
+            if result and result.strip():
+                transcribed_texts.append(result.strip())
+
         return ' '.join(transcribed_texts) if transcribed_texts else ""
     except Exception as e:
         logger.error(f"Error in transcribe_audio_segments: {e}")
         return ""
 
+# Прекомпилированные регулярки для очистки ответа модели (горячий путь саммари)
+_THINK_RE = re.compile(r'<think>.*?</think>', re.DOTALL)
+_TAG_RE = re.compile(r'<[^>]+>')
+_BLANK_RE = re.compile(r'\n\s*\n')
+
+# Общая aiohttp-сессия для API саммари: одно TLS-рукопожатие и DNS-резолв
+# на все вызовы вместо новой сессии (и пары FD) на каждый запрос
+_api_session = None
+
+async def get_api_session():
+    """Ленивая инициализация общей aiohttp-сессии с пулом соединений"""
+    global _api_session
+    if _api_session is None or _api_session.closed:
+        _api_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=120)
+        )
+    return _api_session
+
+async def close_api_session():
+    """Закрывает общую aiohttp-сессию при остановке бота"""
+    if _api_session is not None and not _api_session.closed:
+        await _api_session.close()
+
 async def generate_summary(text: str) -> str:
     """Generate summary using API"""
     url = "https://api.intelligence.io.solutions/api/v1/chat/completions"
@@ -257,29 +477,29 @@ async def generate_summary(text: str) -> str:
     
     try:
         logger.info(f"Attempting API call to: {url}")
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, json=data) as response:
-                logger.info(f"API response status: {response.status}")
-                if response.status != 200:
-                    error = await response.text()
-                    logger.error(f"API error response: {error}")
-                    return f"❌ Ошибка API: {error}"
-                
-                response_data = await response.json()
-                if 'choices' in response_data and len(response_data['choices']) > 0:
-                    bot_response = response_data['choices'][0]['message']['content']
-                    bot_response = re.sub(r'<think>.*?</think>', '', bot_response, flags=re.DOTALL)
-                    bot_response = re.sub(r'<[^>]+>', '', bot_response)
-                    bot_response = re.sub(r'\n\s*\n', '\n', bot_response)
-                    bot_response = bot_response.strip()
-                    
-                    if not bot_response or len(bot_response.strip()) < 10:
-                        return "❌ Получен пустой ответ от модели"
-                    
-                    return bot_response
-                else:
-                    logger.error(f"Unexpected API response structure: {response_data}")
-                    return "❌ Не удалось обработать ответ API"
+        session = await get_api_session()
+        async with session.post(url, headers=headers, json=data) as response:
+            logger.info(f"API response status: {response.status}")
+            if response.status != 200:
+                error = await response.text()
+                logger.error(f"API error response: {error}")
+                return f"❌ Ошибка API: {error}"
+
+            response_data = await response.json()
+            if 'choices' in response_data and len(response_data['choices']) > 0:
+                bot_response = response_data['choices'][0]['message']['content']
+                bot_response = _THINK_RE.sub('', bot_response)
+                bot_response = _TAG_RE.sub('', bot_response)
+                bot_response = _BLANK_RE.sub('\n', bot_response)
+                bot_response = bot_response.strip()
+
+                if not bot_response or len(bot_response.strip()) < 10:
+                    return "❌ Получен пустой ответ от модели"
+
+                return bot_response
+            else:
+                logger.error(f"Unexpected API response structure: {response_data}")
+                return "❌ Не удалось обработать ответ API"
     except Exception as e:
         logger.error(f"Exception during API call: {str(e)}")
         return f"❌ Произошла ошибка: {str(e)}"
@@ -305,10 +525,9 @@ def generate_qr_code(text: str) -> io.BytesIO:
     img_buffer = io.BytesIO()
     img.save(img_buffer, format='PNG')
     img_buffer.seek(0)
-    
-    # Выгружаем qrcode и PIL из памяти после использования
-    unload_heavy_modules()
-    
+
+    # Модули не выгружаем здесь: подряд идущие QR-запросы переиспользуют
+    # уже импортированные qrcode/PIL, выгрузка происходит в idle_unload_monitor
     return img_buffer
 
 def decode_qr_code(image_data: bytes) -> str:
@@ -340,10 +559,9 @@ def decode_qr_code(image_data: bytes) -> str:
     except Exception as e:
         logger.error(f"Error decoding QR code: {e}")
         result = None
-    finally:
-        # Выгружаем cv2 и numpy из памяти после использования
-        unload_heavy_modules()
-    
+
+    # cv2/numpy остаются в памяти до простоя (см. idle_unload_monitor):
+    # повторный импорт cv2 стоит ~300мс и ~80МБ повторных page fault'ов
     return result
 
 # Configure logging with unbuffered output
@@ -393,10 +611,15 @@ def get_db():
         _db = Database()
     return _db
 
-# Для обратной совместимости - создаём объект-прокси
+# Для обратной совместимости - создаём объект-прокси.
+# При первом обращении прокси подменяет глобальную ссылку db на настоящий
+# Database: дальше каждый db.метод — прямой доступ к объекту, без лишнего
+# вызова get_db() и двойного getattr на каждое обращение
 class DatabaseProxy:
     def __getattr__(self, name):
-        return getattr(get_db(), name)
+        real = get_db()
+        globals()['db'] = real
+        return getattr(real, name)
 
 db = DatabaseProxy()
 # Увеличиваем таймаут для больших файлов (по умолчанию 60 секунд, увеличиваем до 600)
@@ -406,6 +629,8 @@ session = AiohttpSession()
 session.timeout = 600  # 10 минут для больших файлов
 bot = Bot(token=BOT_TOKEN, session=session)
 dp = Dispatcher()
+# Аккуратно закрываем общую aiohttp-сессию при остановке polling
+dp.shutdown.register(close_api_session)
 
 # Global event loop for batch processing
 _main_loop = None
@@ -428,6 +653,7 @@ def get_main_loop():
 # Regex patterns
 # Catch URLs with or without protocol (http://, https://, or just domain)
 URL_PATTERN = r'(https?://\S+|(?:instagram\.com|tiktok\.com|vt\.tiktok\.com|youtube\.com|youtu\.be|soundcloud\.com)/\S+)'
+URL_RE = re.compile(URL_PATTERN, re.IGNORECASE)
 
 # Поддерживаемые платформы
 SUPPORTED_PLATFORMS = [
@@ -439,74 +665,70 @@ SUPPORTED_PLATFORMS = [
     'soundcloud.com'
 ]
 
+# Один скомпилированный альтернативный паттерн вместо шести substring-сканов
+# на каждое входящее сообщение
+_SUPPORTED_RE = re.compile('|'.join(re.escape(p) for p in SUPPORTED_PLATFORMS), re.IGNORECASE)
+
 def is_supported_url(url: str) -> bool:
     """Проверяет, поддерживается ли ссылка ботом"""
-    if not url:
-        return False
-    
-    url_lower = url.lower()
-    # Проверяем, содержит ли ссылка один из поддерживаемых доменов
-    return any(platform in url_lower for platform in SUPPORTED_PLATFORMS)
+    return bool(url and _SUPPORTED_RE.search(url))
+
+# Один проход по URL вместо серии отдельных 'x in url' проверок там, где
+# дальше нужен сам хост (cookies, короткие ссылки, SoundCloud-фильтры)
+_HOST_RE = re.compile(r'(instagram\.com|youtube\.com|youtu\.be|vt\.tiktok\.com|soundcloud\.com)')
+_VT_FULL_RE = re.compile(r'/(photo|video)/')
+
+def classify_url(url: str) -> str:
+    """Возвращает известный хост из URL ('' если ни один не найден)"""
+    m = _HOST_RE.search(url)
+    return m.group(1) if m else ''
+
+# Расширения медиафайлов: frozenset вместо списочных литералов в горячих
+# циклах — проверка принадлежности за O(1) и без пересоздания списка на итерацию
+_IMAGE_EXT = frozenset({'.jpg', '.jpeg', '.png', '.webp'})
+_AUDIO_EXT = frozenset({'.mp3', '.m4a', '.aac', '.ogg', '.wav', '.opus', '.flac'})
+_VIDEO_EXT = frozenset({'.mp4', '.mov', '.avi', '.mkv'})
+_MEDIA_EXT = _IMAGE_EXT | _AUDIO_EXT | _VIDEO_EXT
+
+# Какие query-параметры сохранять при нормализации URL каждой платформы;
+# всё остальное (igsh, si, feature и прочий трекинг) отбрасывается.
+# Пустой кортеж — убрать query целиком
+_KEEP_QUERY_PARAMS = {
+    'instagram.com': ('img_index',),  # img_index нужен для каруселей
+    'facebook.com': ('img_index',),
+    'tiktok.com': (),
+    'youtube.com': ('v', 't'),  # ID видео и таймкод
+    'youtu.be': ('v', 't'),
+    'soundcloud.com': (),
+}
 
 def normalize_url(url: str) -> str:
     """Нормализует URL для корректного сравнения (убирает пробелы, лишние параметры)"""
     if not url:
         return url
-    
+
     # Убираем пробелы
     url = url.strip()
-    
+
     try:
-        # Парсим URL
-        from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
         parsed = urlparse(url)
-        
-        # Для Instagram/Facebook
-        if 'instagram.com' in parsed.netloc or 'facebook.com' in parsed.netloc:
-            # Оставляем только путь, убираем query parameters (igsh, etc)
-            # Но сохраняем img_index если есть (для каруселей)
-            query = parse_qs(parsed.query)
-            filtered_query = {}
-            if 'img_index' in query:
-                filtered_query['img_index'] = query['img_index']
-            
-            # Собираем обратно без лишних параметров
-            new_query = urlencode(filtered_query, doseq=True)
-            
-            # Убираем слэш в конце пути, если он не корень
-            path = parsed.path.rstrip('/')
-            
-            return urlunparse((parsed.scheme, parsed.netloc, path, parsed.params, new_query, ''))
-            
-        # Для TikTok
-        elif 'tiktok.com' in parsed.netloc:
-             # Убираем все параметры запроса для TikTok, они обычно трекинговые
-             # Убираем слэш в конце пути
-             path = parsed.path.rstrip('/')
-             return urlunparse((parsed.scheme, parsed.netloc, path, parsed.params, '', ''))
-             
-        # Для YouTube/Shorts
-        elif 'youtube.com' in parsed.netloc or 'youtu.be' in parsed.netloc:
-             # Для YouTube видео ID обычно в query 'v' или в пути (для Shorts)
-             # Очищаем трекинговые параметры типа feature, si, t (если таймкод не нужен)
-             query = parse_qs(parsed.query)
-             allowed_params = ['v', 't'] # Оставляем ID видео и таймкод
-             filtered_query = {k: v for k, v in query.items() if k in allowed_params}
-             new_query = urlencode(filtered_query, doseq=True)
-             # Для Shorts путь содержит /shorts/VIDEO_ID, оставляем как есть
-             # Для обычных видео путь может быть /watch, оставляем как есть
-             path = parsed.path.rstrip('/')
-             return urlunparse((parsed.scheme, parsed.netloc, path, parsed.params, new_query, ''))
-
-        # Для SoundCloud
-        elif 'soundcloud.com' in parsed.netloc:
-             # Убираем трекинговые параметры (обычно query string не нужна для трека)
-             path = parsed.path.rstrip('/')
-             return urlunparse((parsed.scheme, parsed.netloc, path, parsed.params, '', ''))
+
+        # Единая ветка для всех платформ: фильтруем query по таблице,
+        # убираем слэш в конце пути
+        keep = next((params for domain, params in _KEEP_QUERY_PARAMS.items()
+                     if domain in parsed.netloc), None)
+        if keep is not None:
+            if keep:
+                query = parse_qs(parsed.query)
+                new_query = urlencode({k: v for k, v in query.items() if k in keep}, doseq=True)
+            else:
+                new_query = ''
+            return urlunparse((parsed.scheme, parsed.netloc, parsed.path.rstrip('/'),
+                               parsed.params, new_query, ''))
 
     except Exception as e:
         logger.error(f"Error normalizing URL {url}: {e}")
-    
+
     # Fallback если парсинг не удался
     return url.rstrip()
 
@@ -638,6 +860,25 @@ async def on_convert_action(callback: CallbackQuery):
                 except:
                     pass
             
+            # Карусель из кэша: несколько file_id уходят одним send_media_group
+            # (до 10 за вызов) вместо отдельного API-вызова на каждый файл
+            if parts[0] == "conv" and len(file_ids_list) > 1:
+                media_group = []
+                for idx, fid in enumerate(file_ids_list):
+                    media_caption = caption if idx == 0 else None
+                    if file_type == 'video':
+                        media_group.append(InputMediaVideo(media=fid, caption=media_caption))
+                    elif file_type == 'audio':
+                        from aiogram.types import InputMediaAudio
+                        media_group.append(InputMediaAudio(media=fid, caption=media_caption))
+                    else:
+                        media_group.append(InputMediaPhoto(media=fid, caption=media_caption))
+
+                # Лимит Telegram - 10 элементов на альбом
+                for idx in range(0, len(media_group), 10):
+                    await callback.message.answer_media_group(media_group[idx:idx + 10])
+                return
+
             # Отправляем файл в зависимости от типа
             if file_type == 'video':
                 await callback.message.answer_video(file_id, caption=caption, supports_streaming=True)
@@ -672,9 +913,8 @@ async def on_convert_action(callback: CallbackQuery):
     status_msg = await callback.message.answer(f"⏳ Конвертирую в {action_display_text}...")
     
     try:
-        # Download file with retry logic
-        file = await bot.get_file(file_id)
-        file_path = file.file_path
+        # Download file with retry logic (file_path кэшируется по file_id)
+        file_path = await get_file_path(file_id)
         
         # Create temp dir
         task_id = str(uuid.uuid4())
@@ -703,8 +943,8 @@ async def on_convert_action(callback: CallbackQuery):
         # Скачиваем файл напрямую без retry (Telegram API должен справиться)
         await status_msg.edit_text("⏳ Скачиваю файл...")
         try:
-            # Скачиваем файл напрямую (используем стандартный таймаут aiogram)
-            await bot.download_file(file_path, local_input_path)
+            # Скачиваем файл потоково на диск, не буферизуя его в памяти
+            await stream_download_file(file_path, local_input_path)
             
             # Проверяем, что файл действительно скачался
             if not os.path.exists(local_input_path):
@@ -748,38 +988,13 @@ async def on_convert_action(callback: CallbackQuery):
                 await callback.message.answer_video_note(FSInputFile(output_file))
         
         elif action == "transcription":
-            # Для расшифровки нужно сначала извлечь аудио, затем расшифровать
-            await status_msg.edit_text("⏳ Извлекаю аудио...")
-            temp_audio_path = os.path.join(task_dir, "audio.wav")
-            
-            # Извлекаем аудио из видео (с ограничением параллельных операций)
-            async with conversion_semaphore:
-                await asyncio.to_thread(
-                    subprocess.run,
-                    [
-                        'ffmpeg', '-i', local_input_path, '-vn', '-acodec', 'pcm_s16le',
-                        '-ar', '16000', '-ac', '1', '-y', temp_audio_path
-                    ],
-                    check=True,
-                    capture_output=True
-                )
-            
-            if not os.path.exists(temp_audio_path) or os.path.getsize(temp_audio_path) == 0:
-                await status_msg.edit_text("❌ Не удалось извлечь аудио")
+            transcribed_text = await _pipeline_transcribe(
+                local_input_path, task_dir, status_msg, callback.from_user.id)
+            if not transcribed_text:
                 if ENABLE_CLEANUP:
                     await asyncio.to_thread(get_downloader().cleanup, task_dir)
                 return
-            
-            # Расшифровываем аудио
-            await status_msg.edit_text("⏳ Расшифровываю аудио...")
-            transcribed_text = await asyncio.to_thread(transcribe_audio_segments, temp_audio_path)
-            
-            if not transcribed_text or not transcribed_text.strip():
-                await status_msg.edit_text("❌ Не удалось распознать речь")
-                if ENABLE_CLEANUP:
-                    await asyncio.to_thread(get_downloader().cleanup, task_dir)
-                return
-            
+
             # Сохраняем расшифровку в базу данных для последующего саммари
             # Используем cache_id как уникальный идентификатор для этого файла
             file_unique_id = f"conv_{cache_id}"
@@ -793,22 +1008,23 @@ async def on_convert_action(callback: CallbackQuery):
             
             # Отправляем расшифровку с кнопкой саммари
             if len(transcribed_text) > MAX_MESSAGE_LENGTH:
-                # Разбиваем на части
-                words = transcribed_text.split()
-                current_message = ""
+                # Разбиваем на части линейным проходом: режем по последнему
+                # пробелу в пределах лимита, каждая часть — один срез строки
                 messages = []
-                
-                for word in words:
-                    if len(current_message + " " + word) <= MAX_MESSAGE_LENGTH:
-                        current_message += (" " + word) if current_message else word
+                i, n = 0, len(transcribed_text)
+                while i < n:
+                    end = min(i + MAX_MESSAGE_LENGTH, n)
+                    if end < n:
+                        cut = transcribed_text.rfind(' ', i, end + 1)
+                        if cut <= i:
+                            cut = end
                     else:
-                        if current_message:
-                            messages.append(current_message)
-                        current_message = word
-                
-                if current_message:
-                    messages.append(current_message)
-                
+                        cut = end
+                    messages.append(transcribed_text[i:cut])
+                    # Пробел на месте разреза пропускаем, вынужденный разрез
+                    # посреди слова символы не теряет
+                    i = cut + 1 if cut < n and transcribed_text[cut] == ' ' else cut
+
                 # Отправляем все части, кнопку добавляем только к последней
                 for i, msg_text in enumerate(messages):
                     if i == 0:
@@ -830,43 +1046,30 @@ async def on_convert_action(callback: CallbackQuery):
             return
         
         elif action == "summary":
-            # Для саммари нужно сначала извлечь аудио, затем расшифровать и сделать саммари
-            await status_msg.edit_text("⏳ Извлекаю аудио...")
-            temp_audio_path = os.path.join(task_dir, "audio.wav")
-            
-            # Извлекаем аудио из видео (с ограничением параллельных операций)
-            async with conversion_semaphore:
-                await asyncio.to_thread(
-                    subprocess.run,
-                    [
-                        'ffmpeg', '-i', local_input_path, '-vn', '-acodec', 'pcm_s16le',
-                        '-ar', '16000', '-ac', '1', '-y', temp_audio_path
-                    ],
-                    check=True,
-                    capture_output=True
-                )
-            
-            if not os.path.exists(temp_audio_path) or os.path.getsize(temp_audio_path) == 0:
-                await status_msg.edit_text("❌ Не удалось извлечь аудио")
-                if ENABLE_CLEANUP:
-                    await asyncio.to_thread(get_downloader().cleanup, task_dir)
-                return
-            
-            # Расшифровываем аудио (с ограничением параллельных операций)
-            await status_msg.edit_text("⏳ Расшифровываю аудио...")
-            async with transcription_semaphore:
-                transcribed_text = await asyncio.to_thread(transcribe_audio_segments, temp_audio_path)
-            
-            if not transcribed_text or not transcribed_text.strip():
-                await status_msg.edit_text("❌ Не удалось распознать речь")
-                if ENABLE_CLEANUP:
-                    await asyncio.to_thread(get_downloader().cleanup, task_dir)
-                return
-            
-            # Создаем только саммари (без отправки расшифровки)
-            await status_msg.edit_text("⏳ Создаю саммари...")
-            summary = await generate_summary(transcribed_text)
-            
+            # Готовое саммари тоже кэшируем: ключ включает отпечаток файла
+            # и версию промпта, так что правка PROMPT инвалидирует кэш
+            media_hash = await asyncio.to_thread(_quick_media_hash, local_input_path)
+            summary_key = f"summary:{media_hash}:{_PROMPT_TAG}"
+            summary = db.get_transcription(summary_key)
+
+            if not summary:
+                # Прогреваем HTTP-сессию к LLM заранее, чтобы создание
+                # коннектора не добавлялось к латентности первого запроса
+                await get_api_session()
+                transcribed_text = await _pipeline_transcribe(
+                    local_input_path, task_dir, status_msg, callback.from_user.id,
+                    media_hash=media_hash, use_semaphore=True)
+                if not transcribed_text:
+                    if ENABLE_CLEANUP:
+                        await asyncio.to_thread(get_downloader().cleanup, task_dir)
+                    return
+
+                # Создаем только саммари (без отправки расшифровки)
+                await status_msg.edit_text("⏳ Создаю саммари...")
+                summary = await generate_summary(transcribed_text)
+                if summary and not summary.startswith("❌"):
+                    db.save_transcription(summary_key, callback.from_user.id, summary)
+
             await status_msg.edit_text(f"📝 <b>Саммари:</b>\n\n{summary}", parse_mode="HTML")
             if ENABLE_CLEANUP:
                 await asyncio.to_thread(get_downloader().cleanup, task_dir)
@@ -888,9 +1091,9 @@ async def on_convert_action(callback: CallbackQuery):
 # Ключ: URL (нормализованный), значение: Future с результатом (file_ids, file_type)
 active_downloads = {}
 
-# Track sent links to avoid duplicates (max 10000 entries, then clear)
+# Track sent links to avoid duplicates (LRU, вытесняем по одной старой записи)
 # Ключ: (normalized_url, user_id)
-sent_links = set()
+sent_links = OrderedDict()
 MAX_SENT_LINKS = 10000
 
 # Bot username (cached)
@@ -904,49 +1107,108 @@ async def get_bot_username():
         _bot_username = bot_info.username
     return _bot_username
 
+# Кэш file_path по file_id: Telegram гарантирует валидность пути ~1 час,
+# держим 55 минут и экономим get_file round-trip на повторных конвертациях
+_FILE_PATH_TTL = 3300
+_file_path_cache = {}  # file_id -> (monotonic_ts, file_path)
+
+async def get_file_path(file_id):
+    """Возвращает file_path для file_id, кэшируя ответ bot.get_file"""
+    cached = _file_path_cache.get(file_id)
+    if cached is not None and time.monotonic() - cached[0] < _FILE_PATH_TTL:
+        return cached[1]
+
+    file = await bot.get_file(file_id)
+
+    # Не даём кэшу расти бесконечно: на переполнении выкидываем протухшие записи
+    if len(_file_path_cache) > 256:
+        now = time.monotonic()
+        for key in [k for k, (ts, _) in _file_path_cache.items() if now - ts >= _FILE_PATH_TTL]:
+            del _file_path_cache[key]
+
+    _file_path_cache[file_id] = (time.monotonic(), file.file_path)
+    return file.file_path
+
+async def stream_download_file(file_path, destination):
+    """Скачивает файл Telegram на диск чанками по 1 МиБ.
+    bot.download_file буферизует весь ответ в памяти — для большого видео
+    это RSS размером с файл; здесь потребление остаётся ~1 МБ."""
+    url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
+    session = await get_api_session()
+    # Переопределяем таймаут сессии: большой файл может качаться дольше 120с
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300)
+    async with session.get(url, timeout=timeout) as resp:
+        resp.raise_for_status()
+        with open(destination, 'wb') as f:
+            async for chunk in resp.content.iter_chunked(1 << 20):
+                f.write(chunk)
+
+# Файлы меньше этого размера держим в памяти и скармливаем ffmpeg через pipe,
+# не создавая промежуточный входной файл на диске
+PIPE_STDIN_MAX_SIZE = 8 * 1024 * 1024
+
+async def stream_download_bytes(file_path):
+    """Скачивает небольшой файл Telegram в память (для прогонки через pipe)"""
+    url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
+    session = await get_api_session()
+    async with session.get(url) as resp:
+        resp.raise_for_status()
+        buf = bytearray()
+        async for chunk in resp.content.iter_chunked(1 << 20):
+            buf.extend(chunk)
+        return bytes(buf)
+
+# Кэш разрешённых путей к cookies: host -> (путь или None, monotonic-время).
+# Файлы cookies меняются редко, а get_cookies_file зовётся на каждый URL —
+# короткий TTL убирает лишние stat'ы, но обновление файла подхватится за секунды
+_cookie_cache = {}
+_COOKIE_CACHE_TTL = 5.0
+
 def get_cookies_file(url: str) -> str:
     """Определяет правильный файл cookies в зависимости от платформы.
-    Файлы читаются каждый раз заново, без кэширования - можно обновлять без перезапуска бота."""
+    Результат кэшируется на несколько секунд - файлы по-прежнему можно обновлять без перезапуска бота."""
+    platform = classify_url(url)
+    if platform == 'instagram.com':
+        host, filename = 'ig', 'ig_cookies.txt'
+    elif platform in ('youtube.com', 'youtu.be'):
+        host, filename = 'yt', 'yt_cookies.txt'
+    else:
+        host, filename = 'default', None
+
+    cached = _cookie_cache.get(host)
+    if cached and time.monotonic() - cached[1] < _COOKIE_CACHE_TTL:
+        return cached[0]
+
     base_dir = os.path.dirname(__file__)
-    
-    if 'instagram.com' in url:
-        cookies_file = os.path.join(base_dir, 'ig_cookies.txt')
-        if os.path.exists(cookies_file):
-            # Логируем время модификации для отладки
-            try:
-                mtime = os.path.getmtime(cookies_file)
-                logger.debug(f"Using Instagram cookies file (modified: {time.ctime(mtime)})")
-            except:
-                pass
-            return cookies_file
-    elif 'youtube.com' in url or 'youtu.be' in url:
-        cookies_file = os.path.join(base_dir, 'yt_cookies.txt')
-        if os.path.exists(cookies_file):
-            # Логируем время модификации для отладки
-            try:
-                mtime = os.path.getmtime(cookies_file)
-                logger.debug(f"Using YouTube cookies file (modified: {time.ctime(mtime)})")
-            except:
-                pass
-            return cookies_file
-    
-    # Fallback на общий файл cookies
-    cookies_file = os.path.join(base_dir, 'cookies.txt')
-    if os.path.exists(cookies_file):
+    cookies_file = None
+    if filename:
+        candidate = os.path.join(base_dir, filename)
+        if os.path.exists(candidate):
+            cookies_file = candidate
+
+    if cookies_file is None:
+        # Fallback на общий файл cookies
+        candidate = os.path.join(base_dir, 'cookies.txt')
+        if os.path.exists(candidate):
+            cookies_file = candidate
+
+    # Время модификации логируем только когда debug-лог реально включён:
+    # time.ctime + форматирование на горячем пути иначе работают впустую
+    if cookies_file and logger.isEnabledFor(logging.DEBUG):
         try:
             mtime = os.path.getmtime(cookies_file)
-            logger.debug(f"Using general cookies file (modified: {time.ctime(mtime)})")
+            logger.debug(f"Using cookies file {os.path.basename(cookies_file)} (modified: {time.ctime(mtime)})")
         except:
             pass
-        return cookies_file
-    
-    return None
+
+    _cookie_cache[host] = (cookies_file, time.monotonic())
+    return cookies_file
 
 async def expand_short_url(url: str) -> str:
     """Расшифровывает короткие ссылки (vt.tiktok.com и т.д.) в полные URL"""
     try:
         # Проверяем, является ли это короткой ссылкой
-        is_short_url = 'vt.tiktok.com' in url and not any(pattern in url for pattern in ['/photo/', '/video/'])
+        is_short_url = classify_url(url) == 'vt.tiktok.com' and not _VT_FULL_RE.search(url)
         
         # Если это уже полная ссылка, возвращаем как есть
         if not is_short_url:
@@ -1214,25 +1476,24 @@ async def send_link_to_user(user_id: int, url: str, normalized_url: str = None):
     if normalized_url is None:
         normalized_url = normalize_url(url)
     
-    # Очищаем кэш, если он слишком большой
-    if len(sent_links) > MAX_SENT_LINKS:
-        sent_links.clear()
-        logger.info("Cleared sent_links cache")
-    
     # Проверяем, не отправлялась ли уже ссылка этому пользователю
     link_key = (normalized_url, user_id)
     if link_key in sent_links:
+        sent_links.move_to_end(link_key)
         logger.debug(f"Link already sent to user {user_id} for {normalized_url}, skipping")
         return
-    
+
     try:
         await bot.send_message(
             chat_id=user_id,
             text=f"🔗 Ссылка для скачивания:\n{url}",
             disable_notification=True
         )
-        # Помечаем, что ссылка отправлена
-        sent_links.add(link_key)
+        # Помечаем, что ссылка отправлена; при переполнении вытесняем
+        # самую старую запись вместо массовой очистки всего кэша
+        sent_links[link_key] = None
+        if len(sent_links) > MAX_SENT_LINKS:
+            sent_links.popitem(last=False)
         logger.info(f"Sent link to user {user_id}: {url}")
     except Exception as e:
         logger.error(f"Error sending link to user {user_id}: {e}")
@@ -1330,18 +1591,18 @@ async def download_and_cache_inline(url: str, user_id: int, expanded_url: str =
         logger.info(f"[STEP 4/7] Filtering media files from {len(files)} downloaded files...")
         media_files = []
         # Для SoundCloud фильтруем - оставляем только аудио, обложки не отправляем отдельно
-        is_soundcloud = 'soundcloud.com' in normalized_url
+        is_soundcloud = classify_url(normalized_url) == 'soundcloud.com'
         
         for file_path in files:
             ext = os.path.splitext(file_path)[1].lower()
             # Для SoundCloud пропускаем обложки (они будут использоваться как thumbnail)
-            if is_soundcloud and ext in ['.jpg', '.jpeg', '.png', '.webp']:
+            if is_soundcloud and ext in _IMAGE_EXT:
                 logger.info(f"[MEDIA] Skipping thumbnail for SoundCloud: {file_path}")
                 continue
             # Пропускаем только явно не медиа файлы, если нужно. 
             # Но yt-dlp обычно скачивает то, что нужно.
             # Поддерживаем популярные форматы
-            if ext in ['.jpg', '.jpeg', '.png', '.webp', '.mp4', '.mov', '.avi', '.mkv', '.mp3', '.m4a', '.aac', '.ogg', '.wav', '.opus', '.flac']:
+            if ext in _MEDIA_EXT:
                 media_files.append(file_path)
                 logger.info(f"[MEDIA] Added media file: {file_path}")
         
@@ -1360,18 +1621,18 @@ async def download_and_cache_inline(url: str, user_id: int, expanded_url: str =
         # Определяем тип по первому файлу
         if len(media_files) == 1:
             ext = os.path.splitext(media_files[0])[1].lower()
-            if ext in ['.jpg', '.jpeg', '.png', '.webp']:
+            if ext in _IMAGE_EXT:
                 file_type = 'photo'
-            elif ext in ['.mp3', '.m4a', '.aac', '.ogg', '.wav', '.opus', '.flac']:
+            elif ext in _AUDIO_EXT:
                 file_type = 'audio'
             else:
                 file_type = 'video'
         else:
             # Карусель - отправляем массивом
             ext = os.path.splitext(media_files[0])[1].lower()
-            if ext in ['.jpg', '.jpeg', '.png', '.webp']:
+            if ext in _IMAGE_EXT:
                 file_type = 'photo'
-            elif ext in ['.mp3', '.m4a', '.aac', '.ogg', '.wav', '.opus', '.flac']:
+            elif ext in _AUDIO_EXT:
                 file_type = 'audio'
             else:
                 file_type = 'video'
@@ -1574,10 +1835,10 @@ async def download_and_cache_inline(url: str, user_id: int, expanded_url: str =
                 ext = os.path.splitext(file_path)[1].lower()
                 # Подпись только к первому файлу
                 media_caption = caption_with_link if i == 0 else None
-                if ext in ['.jpg', '.jpeg', '.png', '.webp']:
+                if ext in _IMAGE_EXT:
                     media_group.append(InputMediaPhoto(media=FSInputFile(file_path), caption=media_caption))
                     logger.info(f"[MEDIA_GROUP] Added photo {i+1}/{len(media_files)}: {file_path}")
-                elif ext in ['.mp4', '.mov', '.avi', '.mkv']:
+                elif ext in _VIDEO_EXT:
                     media_group.append(InputMediaVideo(media=FSInputFile(file_path), caption=media_caption))
                     logger.info(f"[MEDIA_GROUP] Added video {i+1}/{len(media_files)}: {file_path}")
             
@@ -1881,7 +2142,7 @@ async def inline_handler(query: types.InlineQuery):
             # Если не получилось - это не file_id, продолжаем обработку как обычного текста
             logger.debug(f"Text is not a valid file_id in inline: {e}")
     
-    urls = re.findall(URL_PATTERN, text)
+    urls = URL_RE.findall(text)
     
     if not urls:
         # Пустой результат, если нет ссылок
@@ -2193,11 +2454,13 @@ MAX_CONCURRENT_DOWNLOADS = 10
 MAX_CONCURRENT_CONVERSIONS = 8  # Ограничение на конвертацию (mp3, voice, video_note)
 MAX_CONCURRENT_OPTIMIZATIONS = 4  # Оптимизация видео очень тяжелая - только 1 параллельно
 MAX_CONCURRENT_TRANSCRIPTIONS = 8  # Расшифровка аудио
+MAX_CONCURRENT_SEGMENTS = 8  # Параллельные сегменты внутри одной расшифровки
 
 download_semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
 conversion_semaphore = asyncio.Semaphore(MAX_CONCURRENT_CONVERSIONS)
 optimization_semaphore = asyncio.Semaphore(MAX_CONCURRENT_OPTIMIZATIONS)
 transcription_semaphore = asyncio.Semaphore(MAX_CONCURRENT_TRANSCRIPTIONS)
+segment_semaphore = asyncio.Semaphore(MAX_CONCURRENT_SEGMENTS)
 
 async def delete_status_message_safe(status_message: types.Message, deleted_flag: dict):
     """Безопасно удаляет статусное сообщение только один раз"""
@@ -2512,12 +2775,12 @@ async def process_single_url(message: types.Message, url: str, status_message: t
                 ext = os.path.splitext(file_path)[1].lower()
                 uploaded_file_ids = []
                 
-                if ext in ['.jpg', '.jpeg', '.png', '.webp']:
+                if ext in _IMAGE_EXT:
                     sent_msg = await send_file_with_retry(message, file_path, 'photo', caption)
                     if sent_msg and sent_msg.photo:
                         uploaded_file_ids.append(sent_msg.photo[-1].file_id)
                         file_type = 'photo'
-                elif ext in ['.mp3', '.m4a', '.aac', '.ogg', '.wav', '.opus', '.flac']:
+                elif ext in _AUDIO_EXT:
                     sent_msg = await send_file_with_retry(message, file_path, 'audio', caption)
                     if sent_msg and sent_msg.audio:
                         uploaded_file_ids.append(sent_msg.audio.file_id)
@@ -2710,12 +2973,12 @@ async def process_single_url(message: types.Message, url: str, status_message: t
                     logger.info(f"[MSG] Uploading file: {file_path}, size: {file_size/1024/1024:.2f} MB")
                     sys.stdout.flush()
 
-                    if ext in ['.jpg', '.jpeg', '.png', '.webp']:
+                    if ext in _IMAGE_EXT:
                         sent_msg = await send_file_with_retry(message, file_path, 'photo', caption)
                         if sent_msg and sent_msg.photo:
                             uploaded_file_ids.append(sent_msg.photo[-1].file_id)
                             file_type = 'photo'
-                    elif ext in ['.mp3', '.m4a', '.aac', '.ogg', '.wav', '.opus', '.flac']:
+                    elif ext in _AUDIO_EXT:
                         # Для SoundCloud пытаемся загрузить метаданные и обложку
                         metadata = None
                         thumbnail_path = None
@@ -2744,7 +3007,7 @@ async def process_single_url(message: types.Message, url: str, status_message: t
                                 logger.warning(f"Failed to load metadata: {e}")
                         
                         # Для SoundCloud отправляем обложку отдельным сообщением перед аудио
-                        is_soundcloud = 'soundcloud.com' in normalized_url
+                        is_soundcloud = classify_url(normalized_url) == 'soundcloud.com'
                         cover_file_id = None
                         if is_soundcloud and thumbnail_path and os.path.exists(thumbnail_path):
                             try:
@@ -2925,9 +3188,9 @@ async def process_single_url(message: types.Message, url: str, status_message: t
                             file_size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
                             ext = os.path.splitext(file_path)[1].lower()
                             # Определяем media_type на основе расширения
-                            if ext in ['.jpg', '.jpeg', '.png', '.webp']:
+                            if ext in _IMAGE_EXT:
                                 media_type = 'photo'
-                            elif ext in ['.mp3', '.m4a', '.aac', '.ogg', '.wav', '.opus', '.flac']:
+                            elif ext in _AUDIO_EXT:
                                 media_type = 'audio'
                             else:
                                 media_type = 'video'
@@ -3004,9 +3267,9 @@ async def process_single_url(message: types.Message, url: str, status_message: t
         else:
             # Альбом (карусель) - отправляем массивом и сохраняем все в кэш
                 # Для SoundCloud фильтруем файлы - отправляем только аудио, обложки не отправляем отдельно
-                if 'soundcloud.com' in normalized_url:
+                if classify_url(normalized_url) == 'soundcloud.com':
                     # Для SoundCloud должен быть только один аудио файл
-                    audio_files = [f for f in files if os.path.splitext(f)[1].lower() in ['.mp3', '.m4a', '.aac', '.ogg', '.wav', '.opus', '.flac']]
+                    audio_files = [f for f in files if os.path.splitext(f)[1].lower() in _AUDIO_EXT]
                     if audio_files:
                         # Отправляем как одиночный аудио файл с обложкой
                         file_path = audio_files[0]
@@ -3086,7 +3349,7 @@ async def process_single_url(message: types.Message, url: str, status_message: t
                 for i, file_path in enumerate(files):
                     ext = os.path.splitext(file_path)[1].lower()
                     
-                    if ext in ['.mp4', '.mov', '.avi', '.mkv']:
+                    if ext in _VIDEO_EXT:
                         # Проверяем, нужно ли оптимизировать видео
                         needs_opt, opt_reason = await asyncio.to_thread(get_downloader().needs_telegram_optimization, file_path)
                         
@@ -3114,10 +3377,10 @@ async def process_single_url(message: types.Message, url: str, status_message: t
                     if i in optimized_files_map:
                         file_path = optimized_files_map[i]
                     
-                    if ext in ['.jpg', '.jpeg', '.png', '.webp']:
+                    if ext in _IMAGE_EXT:
                         media_group.append(InputMediaPhoto(media=FSInputFile(file_path), caption=media_caption))
                         carousel_type = 'photo'
-                    elif ext in ['.mp4', '.mov', '.avi', '.mkv']:
+                    elif ext in _VIDEO_EXT:
                         media_group.append(InputMediaVideo(media=FSInputFile(file_path), caption=media_caption))
                         carousel_type = 'video'
                 
@@ -3364,103 +3627,40 @@ async def handle_audio_file(message: types.Message):
     markup = get_convert_keyboard(cache_id=cache_id, bot_username=bot_username)
     await message.answer("✅ Получил файл", reply_markup=markup)
 
-def add_message_to_batch(user_id, message):
-    """Add message to user's batch and process with delay"""
-    current_time = time.time()
-    
-    with batch_lock:
-        if user_id not in user_message_batches:
-            user_message_batches[user_id] = []
-        
-        # Check if this is a rapid succession of messages (within 2 seconds)
-        is_rapid = (user_id in user_last_message_time and 
-                   current_time - user_last_message_time[user_id] < 2.0)
-        
-        user_message_batches[user_id].append(message)
-        user_last_message_time[user_id] = current_time
-        
-        # Cancel existing timer if any
-        if user_id in batch_timers:
-            batch_timers[user_id].cancel()
-        
-        # Special handling for voice messages - always group them
-        if message.content_type in ['voice', 'video_note']:
-            # For voice messages, always wait a bit to see if more come
-            def run_process_batch():
-                try:
-                    loop = get_main_loop()
-                    if loop and loop.is_running():
-                        # Use run_coroutine_threadsafe to schedule in main loop
-                        future = asyncio.run_coroutine_threadsafe(process_batch(user_id), loop)
-                        future.result()  # Wait for completion
-                    else:
-                        # Fallback: create new loop if main loop not available
-                        new_loop = asyncio.new_event_loop()
-                        asyncio.set_event_loop(new_loop)
-                        new_loop.run_until_complete(process_batch(user_id))
-                        new_loop.close()
-                except Exception as e:
-                    logger.error(f"Error in run_process_batch: {e}", exc_info=True)
-            
-            timer = threading.Timer(BATCH_TIMEOUT, run_process_batch)
-            batch_timers[user_id] = timer
-            timer.start()
-        # For other messages, check if rapid or batch is full
-        elif is_rapid or len(user_message_batches[user_id]) >= BATCH_MAX_SIZE:
-            def run_process_batch():
-                try:
-                    loop = get_main_loop()
-                    if loop and loop.is_running():
-                        # Use run_coroutine_threadsafe to schedule in main loop
-                        future = asyncio.run_coroutine_threadsafe(process_batch(user_id), loop)
-                        future.result()  # Wait for completion
-                    else:
-                        # Fallback: create new loop if main loop not available
-                        new_loop = asyncio.new_event_loop()
-                        asyncio.set_event_loop(new_loop)
-                        new_loop.run_until_complete(process_batch(user_id))
-                        new_loop.close()
-                except Exception as e:
-                    logger.error(f"Error in run_process_batch: {e}", exc_info=True)
-            run_process_batch()
-        else:
-            # Start minimal timer for single messages
-            def run_process_batch():
+async def add_message_to_batch(user_id, message):
+    """Кладёт сообщение в очередь пользователя; воркер сам собирает батч"""
+    user_last_message_time[user_id] = time.time()
+
+    queue = _user_queues.get(user_id)
+    if queue is None:
+        queue = asyncio.Queue(maxsize=BATCH_MAX_SIZE)
+        _user_queues[user_id] = queue
+        _user_workers[user_id] = asyncio.create_task(_batch_worker(user_id, queue))
+
+    await queue.put(message)
+
+async def _batch_worker(user_id, queue):
+    """Воркер одного пользователя: ждёт паузу BATCH_TIMEOUT после последнего
+    сообщения (или BATCH_MAX_SIZE) и отдаёт накопленный батч в process_batch.
+    Разные пользователи обрабатываются независимо, без общего лока."""
+    while True:
+        try:
+            first = await queue.get()
+            batch = [first]
+            while len(batch) < BATCH_MAX_SIZE:
                 try:
-                    loop = get_main_loop()
-                    if loop and loop.is_running():
-                        # Use run_coroutine_threadsafe to schedule in main loop
-                        future = asyncio.run_coroutine_threadsafe(process_batch(user_id), loop)
-                        future.result()  # Wait for completion
-                    else:
-                        # Fallback: create new loop if main loop not available
-                        new_loop = asyncio.new_event_loop()
-                        asyncio.set_event_loop(new_loop)
-                        new_loop.run_until_complete(process_batch(user_id))
-                        new_loop.close()
-                except Exception as e:
-                    logger.error(f"Error in run_process_batch: {e}", exc_info=True)
-            
-            timer = threading.Timer(BATCH_TIMEOUT, run_process_batch)
-            batch_timers[user_id] = timer
-            timer.start()
+                    batch.append(await asyncio.wait_for(queue.get(), timeout=BATCH_TIMEOUT))
+                except asyncio.TimeoutError:
+                    break
+            await process_batch(user_id, batch)
+        except Exception as e:
+            logger.error(f"Error in batch worker for user {user_id}: {e}", exc_info=True)
 
-async def process_batch(user_id):
+async def process_batch(user_id, messages):
     """Process all messages in user's batch"""
-    with batch_lock:
-        if user_id not in user_message_batches or not user_message_batches[user_id]:
-            return
-        
-        messages = user_message_batches[user_id].copy()
-        user_message_batches[user_id] = []
-        
-        if user_id in batch_timers:
-            batch_timers[user_id].cancel()
-            del batch_timers[user_id]
-    
     if not messages:
         return
-    
+
     # Update last message time
     user_last_message_time[user_id] = time.time()
     
@@ -3511,9 +3711,10 @@ async def process_voice_batch(voice_messages):
         # Download all files in parallel
         await status_msg.edit_text(f"🎙️ Скачиваю {len(voice_messages)} файлов... [██░░░░░░░░] 20%")
         
-        downloaded_files = []
-        file_unique_ids = []
-        
+        downloaded_files = []  # (индекс в батче, путь) только для некэшированных
+        file_unique_ids = [None] * len(voice_messages)
+        transcribed_texts = [None] * len(voice_messages)
+
         for i, message in enumerate(voice_messages):
             if message.content_type == 'voice':
                 file_content = message.voice
@@ -3522,63 +3723,77 @@ async def process_voice_batch(voice_messages):
                 file_content = message.video_note
                 input_extension = 'mp4'
             else:
+                transcribed_texts[i] = ""
                 continue
-            
+
+            file_unique_ids[i] = file_content.file_unique_id
+
+            # Первый уровень кэша: file_unique_id стабилен для одного и того же
+            # аудио, пересланное повторно сообщение не скачиваем и не гоняем в Google
+            cached_text = db.get_transcription(file_content.file_unique_id)
+            if cached_text:
+                logger.info(f"Transcription cache hit for file_unique_id: {file_content.file_unique_id}")
+                transcribed_texts[i] = cached_text
+                continue
+
             file_info = await bot.get_file(file_content.file_id)
             # Используем индекс сообщения в имени файла, чтобы избежать перезаписи при одинаковых file_unique_id
             # и сохранить порядок сообщений
-            temp_input_path = os.path.join(tempfile.gettempdir(), f"{file_content.file_unique_id}_{i}_{message.message_id}.{input_extension}")
-            await bot.download_file(file_info.file_path, destination=temp_input_path)
-            
-            downloaded_files.append(temp_input_path)
-            file_unique_ids.append(file_content.file_unique_id)
-        
+            temp_name = f"{file_content.file_unique_id}_{i}_{message.message_id}"
+
+            # Небольшие голосовые держим в памяти: pydub передаст их в ffmpeg
+            # через stdin, без промежуточного входного файла на диске.
+            # video_note (mp4) через pipe не гоняем — mp4 требует seek по входу
+            if (input_extension == 'ogg' and file_content.file_size
+                    and file_content.file_size < PIPE_STDIN_MAX_SIZE):
+                source = await stream_download_bytes(file_info.file_path)
+            else:
+                source = os.path.join(tempfile.gettempdir(), f"{temp_name}.{input_extension}")
+                await stream_download_file(file_info.file_path, source)
+
+            wav_path = os.path.join(tempfile.gettempdir(), f"{temp_name}.wav")
+            downloaded_files.append((i, source, wav_path, input_extension))
+
         # Convert all files to optimized audio format
         await status_msg.edit_text(f"🎙️ Оптимизирую аудио... [████░░░░░░] 40%")
-        
+
         # Ленивая загрузка pydub только когда нужно обрабатывать аудио
         from pydub import AudioSegment
-        
-        audio_files = []
-        for temp_input_path in downloaded_files:
-            audio = AudioSegment.from_file(temp_input_path, format=temp_input_path.split('.')[-1])
+
+        audio_files = []  # (индекс в батче, путь к wav)
+        for i, source, wav_path, input_extension in downloaded_files:
+            if isinstance(source, bytes):
+                audio = AudioSegment.from_file(io.BytesIO(source), format=input_extension)
+            else:
+                audio = AudioSegment.from_file(source, format=input_extension)
             audio = audio.normalize()
             audio = audio.high_pass_filter(80)
-            
-            temp_audio_path = temp_input_path.replace(f".{temp_input_path.split('.')[-1]}", ".wav")
+
             audio.set_frame_rate(16000).set_channels(1).set_sample_width(2).export(
-                temp_audio_path,
+                wav_path,
                 format="wav",
                 parameters=["-ac", "1", "-ar", "16000", "-acodec", "pcm_s16le"]
             )
-            audio_files.append(temp_audio_path)
-        
+            audio_files.append((i, wav_path))
+
         # Выгружаем pydub из памяти после конвертации (перед транскрибацией загрузится speech_recognition)
         unload_heavy_modules()
-        
+
         # Transcribe all files in parallel
         await status_msg.edit_text(f"🎙️ Расшифровываю {len(voice_messages)} сообщений... [██████░░░░] 60%")
-        
-        # Create futures with their indices to maintain order
-        with ThreadPoolExecutor(max_workers=min(len(audio_files), 16)) as executor:
-            future_to_index = {}
-            for i, audio_file in enumerate(audio_files):
-                future = executor.submit(transcribe_audio_segments, audio_file)
-                future_to_index[future] = i
-            
-            # Initialize results list with correct size
-            transcribed_texts = [None] * len(audio_files)
-            
-            # Collect results in any order, but store them at correct indices
-            for future in future_to_index:
-                try:
-                    text = future.result()
-                    index = future_to_index[future]
-                    transcribed_texts[index] = text
-                except Exception as e:
-                    logger.error(f"Transcription error: {e}")
-                    index = future_to_index[future]
-                    transcribed_texts[index] = ""
+
+        # asyncio.gather сохраняет порядок результатов
+        results = await asyncio.gather(
+            *(transcribe_audio_segments(audio_file) for _, audio_file in audio_files),
+            return_exceptions=True
+        )
+
+        for (i, _), result in zip(audio_files, results):
+            if isinstance(result, Exception):
+                logger.error(f"Transcription error: {result}")
+                transcribed_texts[i] = ""
+            else:
+                transcribed_texts[i] = result
         
         # Combine all transcriptions
         await status_msg.edit_text(f"📝 Объединяю результаты... [████████░░] 80%")
@@ -3598,10 +3813,13 @@ async def process_voice_batch(voice_messages):
             await status_msg.edit_text("❌ Не удалось распознать речь ни в одном из сообщений. Попробуйте записать заново.")
             return
         
-        # Store transcriptions in database
+        # Store transcriptions in database. Кэшированные строки тоже
+        # пересохраняем под текущим user_id: поиск для кнопки "саммари"
+        # фильтрует по пользователю, и попадание в чужую запись иначе
+        # оставило бы кнопку нерабочей. Это один дешёвый upsert на сообщение
         user_id = first_message.from_user.id
         for file_unique_id, text in zip(file_unique_ids, transcribed_texts):
-            if text and text.strip():  # Only store non-empty transcriptions
+            if file_unique_id and text and text.strip():  # Only store non-empty transcriptions
                 db.save_transcription(file_unique_id, user_id, text)
                 logger.info(f"Saved transcription for file_unique_id: {file_unique_id}, user: {user_id}")
         
@@ -3777,8 +3995,10 @@ async def process_voice_batch(voice_messages):
         except Exception as e:
             logger.warning(f"Could not delete status message: {e}")
         
-        # Clean up all temporary files
-        for file_path in downloaded_files + audio_files:
+        # Clean up all temporary files (in-memory источники чистить не нужно)
+        temp_paths = [source for _, source, _, _ in downloaded_files if isinstance(source, str)]
+        temp_paths += [wav_path for _, wav_path in audio_files]
+        for file_path in temp_paths:
             if os.path.exists(file_path):
                 try:
                     os.remove(file_path)
@@ -3846,7 +4066,7 @@ async def handle_voice_or_video_note(message: types.Message):
     db.add_user(message.from_user)
     
     # Добавляем сообщение в батч для обработки
-    add_message_to_batch(message.from_user.id, message)
+    await add_message_to_batch(message.from_user.id, message)
 
 @dp.callback_query(F.data.startswith("summarize:"))
 async def handle_summarize_callback(callback: CallbackQuery):
@@ -3991,7 +4211,7 @@ async def handle_message(message: types.Message):
                 file_path = f"downloads/temp_{uuid.uuid4()}/{file.file_path.split('/')[-1]}"
                 os.makedirs(os.path.dirname(file_path), exist_ok=True)
                 
-                await bot.download_file(file.file_path, file_path)
+                await stream_download_file(file.file_path, file_path)
                 log_resource_usage(f"Downloaded file from file_id: {file_path}")
                 
                 # Определяем тип файла по file_id префиксу и расширению
@@ -4121,7 +4341,7 @@ async def handle_message(message: types.Message):
             logger.debug(f"Text is not a valid file_id: {e}")
     
     # Ищем все ссылки
-    urls = re.findall(URL_PATTERN, message.text)
+    urls = URL_RE.findall(message.text)
     
     if not urls:
         # Если это не ссылка, просто просим отправить ссылку
@@ -4218,6 +4438,8 @@ async def cleanup_expired_files_periodically():
             deleted_count = await asyncio.to_thread(db.cleanup_expired_files)
             if deleted_count > 0:
                 logger.info(f"Cleaned up {deleted_count} expired file records")
+            # Кэш расшифровок и саммари растёт бесконечно — подрезаем старые записи
+            await asyncio.to_thread(db.prune_transcriptions)
         except Exception as e:
             logger.error(f"Error in cleanup task: {e}")
 
@@ -4270,6 +4492,25 @@ async def cleanup_downloads_when_idle():
         except Exception as e:
             logger.error(f"[CLEANUP] Error in cleanup_downloads_when_idle: {e}")
 
+# Сколько секунд простоя ждать перед выгрузкой тяжёлых модулей
+IDLE_UNLOAD_TIMEOUT = 600
+
+async def idle_unload_monitor():
+    """Выгружает тяжёлые модули только после простоя, а не на каждый запрос"""
+    while True:
+        try:
+            await asyncio.sleep(60)
+
+            if len(active_downloads) > 0:
+                continue
+
+            last_message = max(user_last_message_time.values(), default=0)
+            last_activity = max(_last_activity_time or 0, last_message)
+            if time.time() - last_activity > IDLE_UNLOAD_TIMEOUT:
+                unload_heavy_modules()
+        except Exception as e:
+            logger.error(f"[UNLOAD] Error in idle_unload_monitor: {e}")
+
 async def smart_restart_monitor():
     """Умный мониторинг памяти и перезапуск бота при необходимости"""
     global _last_activity_time, _restart_cooldown
@@ -4349,7 +4590,16 @@ async def smart_restart_monitor():
 
 async def main():
     # Сохраняем основной event loop для batch processing
-    set_main_loop(asyncio.get_event_loop())
+    loop = asyncio.get_event_loop()
+    set_main_loop(loop)
+
+    # Дефолтный executor asyncio — min(32, cpu+4) потоков; на 2-ядерной VPS
+    # это 6, меньше, чем допускают наши семафоры. Работа в нём I/O-bound
+    # (сеть, ffmpeg-процессы), так что потоков можно дать с запасом
+    loop.set_default_executor(ThreadPoolExecutor(
+        max_workers=int(os.environ.get("THREAD_POOL_SIZE", "64")),
+        thread_name_prefix="bot-io"
+    ))
     
     # Определяем username бота при старте
     await get_bot_username()
@@ -4377,6 +4627,10 @@ async def main():
         # Запускаем задачу умного мониторинга памяти и перезапуска (ленивая загрузка psutil)
         asyncio.create_task(smart_restart_monitor())
         logger.info("Started smart restart monitor")
+
+        # Запускаем выгрузку тяжёлых модулей по простою
+        asyncio.create_task(idle_unload_monitor())
+        logger.info("Started idle module unload monitor")
         
         # Первоначальная очистка при старте (только через 5 минут)
         try:
@@ -23,3 +23,13 @@ USE_PROXY = True
 # If False, API website will not be started
 ENABLE_API = True
 
+# Run speech-to-text segments in a process pool instead of threads
+# Only useful with a CPU-bound local STT backend (Vosk/Whisper);
+# the default Google HTTP backend is I/O-bound and runs fine in threads
+USE_PROCESS_POOL_STT = os.environ.get("USE_PROCESS_POOL_STT", "0") == "1"
+
+# Serve /files/ downloads through nginx via X-Accel-Redirect
+# Requires an "internal" nginx location aliased to the project root;
+# if False, files are streamed by the Flask worker itself
+USE_X_ACCEL_REDIRECT = os.environ.get("USE_X_ACCEL_REDIRECT", "0") == "1"
+
@@ -1,15 +1,21 @@
 import sqlite3
 import logging
 import json
+from collections import OrderedDict
 from datetime import datetime
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Размер in-process LRU перед file_cache (dict-hit вместо SQL-запроса
+# для повторяющихся URL; инвалидируется при записи)
+_CACHE_LRU_MAX = 1024
+
 class Database:
     def __init__(self, db_file="bot_database.db"):
         self.connection = sqlite3.connect(db_file, check_same_thread=False)
         self.cursor = self.connection.cursor()
+        self._cache_entry_lru = OrderedDict()
         self.create_tables()
 
     def create_tables(self):
@@ -147,6 +153,8 @@ class Database:
 
     def save_file_to_cache(self, url, file_ids, media_type, user_id):
         """Сохраняет один file_id или список file_ids в кэш. Возвращает id записи."""
+        # Запись делает закэшированный lookup неактуальным
+        self._cache_entry_lru.pop(url, None)
         try:
             # Преобразуем в JSON строку
             if isinstance(file_ids, list):
@@ -201,6 +209,40 @@ class Database:
             logger.error(f"Error getting file by id: {e}")
             return None
     
+    def get_cache_entry(self, url):
+        """Получает (file_ids, media_type, cache_id) одним SELECT.
+
+        Горячий путь API делал два запроса по одному и тому же url
+        (get_cached_file + get_cache_id_by_url) - здесь то же самое
+        одним обращением к базе. Повторные запросы того же url попадают
+        в маленький LRU и не ходят в SQLite вовсе."""
+        cached = self._cache_entry_lru.get(url)
+        if cached is not None:
+            self._cache_entry_lru.move_to_end(url)
+            return cached
+        try:
+            self.cursor.execute("SELECT file_id, media_type, id FROM file_cache WHERE url = ?", (url,))
+            result = self.cursor.fetchone()
+            if result:
+                file_id_str, media_type, cache_id = result
+                # Если это JSON (карусель), парсим
+                try:
+                    file_ids = json.loads(file_id_str)
+                    if not isinstance(file_ids, list):
+                        file_ids = [file_ids]
+                except:
+                    # Один файл
+                    file_ids = [file_id_str]
+                entry = (file_ids, media_type, cache_id)
+                self._cache_entry_lru[url] = entry
+                if len(self._cache_entry_lru) > _CACHE_LRU_MAX:
+                    self._cache_entry_lru.popitem(last=False)
+                return entry
+            return None
+        except Exception as e:
+            logger.error(f"Error getting cache entry: {e}")
+            return None
+
     def get_cache_id_by_url(self, url):
         """Получает cache_id по URL"""
         try:
@@ -244,12 +286,37 @@ class Database:
             logger.error(f"Error getting transcription: {e}")
             return None
     
+    def prune_transcriptions(self, max_rows=50000):
+        """Ограничивает размер кэша расшифровок, удаляя самые старые записи"""
+        try:
+            self.cursor.execute("""
+                DELETE FROM transcriptions WHERE id NOT IN (
+                    SELECT id FROM transcriptions ORDER BY created_at DESC LIMIT ?
+                )
+            """, (max_rows,))
+            deleted = self.cursor.rowcount
+            self.connection.commit()
+            if deleted > 0:
+                logger.info(f"Pruned {deleted} old transcriptions")
+            return True
+        except Exception as e:
+            logger.error(f"Error pruning transcriptions: {e}")
+            return False
+
     def get_user_transcriptions(self, user_id):
-        """Получает все расшифровки пользователя"""
+        """Получает все расшифровки пользователя.
+
+        Служебные записи кэша (ключи hash:/media:/summary:) не возвращаем:
+        это дубликаты тех же текстов под синтетическими ключами, в сводном
+        саммари они считали бы один транскрипт по два-три раза.
+        """
         try:
             self.cursor.execute("""
-                SELECT file_unique_id, transcription_text FROM transcriptions 
+                SELECT file_unique_id, transcription_text FROM transcriptions
                 WHERE user_id = ?
+                  AND file_unique_id NOT LIKE 'hash:%'
+                  AND file_unique_id NOT LIKE 'media:%'
+                  AND file_unique_id NOT LIKE 'summary:%'
                 ORDER BY created_at DESC
             """, (user_id,))
             return dict(self.cursor.fetchall())